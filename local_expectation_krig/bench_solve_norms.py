@@ -0,0 +1,130 @@
+"""
+Program to time the assembly of the least squares problem in solve_norms,
+comparing the original loops with the vectorised construction, on
+synthetic station data. A small network with a station that never reports
+is then solved by each method, as a check that the rank deficient normal
+equations fall back to the pseudo-inverse.
+
+Arguments:
+ -stations=<n> : number of stations (default 1000)
+ -months=<n> : number of months (default 2892)
+ -missing=<f> : fraction of missing observations (default 0.3)
+ -breaks=<n> : maximum number of breaks per station (default 3)
+ -fill=<n> : number of months for which to time filling A (default 4)
+"""
+import contextlib, io, sys, time, numpy, glosat_homogenization
+
+
+# original equation and parameter lists
+def loop_tables( obs, flags ):
+  nmon, nstn = obs.shape
+  eqns = []
+  pars = []
+  for s in range(nstn):
+    for m in range(nmon):
+      if not numpy.isnan( obs[m,s] ):
+        eqns.append( (m,s) )
+    frags = numpy.unique( flags[:,s] )
+    for f in frags:
+      pars.append( (f,s) )
+  return numpy.array(eqns,dtype=int), numpy.array(pars,dtype=int)
+
+
+# original fill of the coefficients for the equations in one month
+def loop_fill( A, eqns, pars, flags, wijt, m ):
+  for e in numpy.nonzero(eqns[:,0] == m)[0]:
+    s2 = eqns[e,1]
+    pmsk = flags[m,pars[:,1]] == pars[:,0]
+    A[e,pmsk] = wijt[pars[pmsk,1],s2]
+
+
+# check the solutions when one station has no observations
+def check_empty_station( nfourier ):
+  rng = numpy.random.default_rng( 1 )
+  nstn, nmon = 25, 240
+  lats = rng.uniform( -40.0, 40.0, nstn )
+  lons = rng.uniform( -40.0, 40.0, nstn )
+  cov = numpy.exp( -glosat_homogenization.prepare_dists( lats, lons )/900.0 )
+  obs = rng.normal( size=[nmon,nstn] )
+  obs[ rng.random( [nmon,nstn] ) < 0.2 ] = numpy.nan
+  obs[:,3] = numpy.nan
+  flags = numpy.zeros( [nmon,nstn], dtype=int )
+  flags[120:,5] = 1
+  flags[230:,7] = 1
+  for method in [ "dense", "sparse", "normal" ]:
+    with contextlib.redirect_stdout( io.StringIO() ):
+      norms, norme = glosat_homogenization.solve_norms( obs, flags, cov, 0.1, nfourier, diagnostics=0, method=method )
+    print("Empty station: {:6s} fourier {:d}  max norm {:9.3g}  max uncertainty {:9.3g}".format(
+      method, nfourier, numpy.max(numpy.abs(norms[:,3])), numpy.max(norme) ))
+    assert numpy.max( numpy.abs( norms[:,3] ) ) < 1.0e-6 and numpy.max( norme ) < 1.0
+
+
+# MAIN PROGRAM
+def main():
+  # command line arguments
+  nstn, nmon = 1000, 2892
+  missing = 0.3
+  nbreak = 3
+  nfill = 4
+  for arg in sys.argv[1:]:
+    if arg.split("=")[0] == "-stations": # number of stations
+      nstn = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-months":   # number of months
+      nmon = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-missing":  # missing fraction
+      missing = float(arg.split("=")[1])
+    if arg.split("=")[0] == "-breaks":   # breaks per station
+      nbreak = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-fill":     # months to fill
+      nfill = int(arg.split("=")[1])
+
+  # synthetic observations and fragment flags
+  rng = numpy.random.default_rng( 0 )
+  obs = rng.normal( size=[nmon,nstn] )
+  obs[ rng.random( [nmon,nstn] ) < missing ] = numpy.nan
+  flags = numpy.zeros( [nmon,nstn], dtype=numpy.uint8 )
+  for s in range(nstn):
+    for b in rng.integers( 1, nmon, size=rng.integers(0,nbreak+1) ):
+      flags[b:,s] += 1
+  print("Stations",nstn,"months",nmon,"observations",numpy.count_nonzero(~numpy.isnan(obs)))
+
+  # equation and parameter tables
+  t0 = time.time()
+  eqns0, pars0 = loop_tables( obs, flags )
+  t1 = time.time()
+  eqns, pars, pidx, emap = glosat_homogenization.norm_tables( obs, flags )
+  t2 = time.time()
+  assert numpy.array_equal( eqns0, eqns ) and numpy.array_equal( pars0, pars )
+  print("Tables:    loop {:9.3f}s  vectorised {:9.3f}s".format( t1-t0, t2-t1 ))
+
+  # coefficients for the first few months, from a stand-in weight matrix
+  mons = numpy.arange( min(nfill,nmon) )
+  erows = numpy.nonzero( numpy.isin( eqns[:,0], mons ) )[0]
+  A0 = numpy.zeros( [erows.size,pars.shape[0]] )
+  A1 = numpy.zeros( [erows.size,pars.shape[0]] )
+  sub = eqns[erows]
+  rmap = numpy.full( [eqns.shape[0]], -1 )
+  rmap[erows] = numpy.arange( erows.size )
+  tl = ts = 0.0
+  for m in mons:
+    wijt = rng.normal( size=[nstn,nstn] )
+    t0 = time.time()
+    loop_fill( A0, sub, pars, flags, wijt, m )
+    t1 = time.time()
+    sobs = numpy.nonzero( emap[m,:] >= 0 )[0]
+    A1[rmap[emap[m,sobs]][:,numpy.newaxis],pidx[m,numpy.newaxis,:]] = wijt[:,sobs].T
+    t2 = time.time()
+    tl += t1-t0
+    ts += t2-t1
+  assert numpy.array_equal( A0, A1 )
+  print("Fill A:    loop {:9.3f}s  scatter    {:9.3f}s  per month".format( tl/mons.size, ts/mons.size ))
+  print("Assembly:  loop {:9.3f}s  vectorised {:9.3f}s  estimated for all months".format(
+    tl/mons.size*nmon, ts/mons.size*nmon ))
+
+  # rank deficient normal equations
+  for nfourier in range(2): check_empty_station( nfourier )
+
+
+# Main program launcher
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,9 @@ Arguments:
  -i=<filename> : specific input pkl file (default ../DATA/df_temp.pkl)
  -o=<filename> : specific output pkl file (default df_temp_expect.pkl) 
  -years=<year>,<year> : years for calculation (default 1780,2020)
+ -distcache=<dir> : directory for cached distance matrices
 """
-import sys, math, numpy, pandas, ruptures, glosat_homogenization
+import sys, math, numpy, pandas, glosat_homogenization
 import statsmodels.api as sm
 import matplotlib.pyplot as plt
 
@@ -27,6 +28,7 @@ def anomaly_diff2( x ):
 def main():
   # command line arguments
   year0,year1 = 1780,2020
+  distcache = None
   ystep = 50
   stationfilter = None
   ifile = None
@@ -37,6 +39,8 @@ def main():
       ifile = arg.split("=")[1]
     if arg.split("=")[0] == "-o":        # output file
       ofile = arg.split("=")[1]
+    if arg.split("=")[0] == "-distcache": # distance matrix cache
+      distcache = arg.split("=")[1]
     if arg.split("=")[0] == "-years":    # year calc
       year0,year1 = [int(x) for x in arg.split("=")[1].split(",")]
     if arg.split("=")[0] == "-step":     # year step 
@@ -77,7 +81,7 @@ def main():
   ctrys = dsub.loc[:,"stationcountry"].values
   lats  = dsub.loc[:,"stationlat"].values
   lons  = dsub.loc[:,"stationlon"].values
-  dists = glosat_homogenization.prepare_dists( lats, lons )
+  dists = glosat_homogenization.prepare_dists( lats, lons, cachedir=distcache )
 
   # and full data
   dcodes = dflt.loc[:,"stationcode"].values
@@ -10,6 +10,8 @@ Arguments:
  -filter=<filter> : only use stations with given prefix
  -years=<year>,<year> : years for calculation (default 1780,2020)
  -bases=<year>,<year> : baseline years (default 1961,1990)
+ -distcache=<dir> : directory for cached distance matrices
+ -solver=<method> : norm solver, dense, normal, sparse or lsqr (default dense)
 
 If cycles is zero (the default), then calculate local expectation only.
 """
@@ -20,9 +22,11 @@ import sys, math, numpy, pandas, glosat_homogenization
 def main():
   # command line arguments
   year0,year1 = 1780,2020
+  distcache = None
   base0,base1 = 1961,1990
   stationfilter = None
   tor = 0.1
+  solver = "dense"
   nfourier = 0
   ncycle   = 10
   rebaseline = True
@@ -34,6 +38,10 @@ def main():
       ifile = arg.split("=")[1]
     if arg.split("=")[0] == "-o":        # output file
       ofile = arg.split("=")[1]
+    if arg.split("=")[0] == "-distcache": # distance matrix cache
+      distcache = arg.split("=")[1]
+    if arg.split("=")[0] == "-solver":   # norm solver
+      solver = arg.split("=")[1]
     if arg.split("=")[0] == "-years":    # year calc
       year0,year1 = [int(x) for x in arg.split("=")[1].split(",")]
     if arg.split("=")[0] == "-bases":    # year calc
@@ -79,7 +87,7 @@ def main():
   ctrys = dsub.loc[:,"stationcountry"].values
   lats  = dsub.loc[:,"stationlat"].values
   lons  = dsub.loc[:,"stationlon"].values
-  dists = glosat_homogenization.prepare_dists( lats, lons )
+  dists = glosat_homogenization.prepare_dists( lats, lons, cachedir=distcache )
 
   # and full data
   dcodes = dflt.loc[:,"stationcode"].values
@@ -120,6 +128,9 @@ def main():
   data[data>100.0] -= 200.0
   print("Data flag removal ",numpy.nanmin(data),numpy.nanmax(data))
 
+  # report the mask compression, i.e. how many months share each set of reporting stations
+  glosat_homogenization.mask_groups( ~numpy.isnan(data), report=True )
+
   # simple normalization for annual cycle
   # -------------------------------------
   # This step does a basic anomaly calculation to remove the bulk of the annual cycle
@@ -132,7 +143,7 @@ def main():
   # -------------------------------
   # We create an empyty array of station breakpoint flags in order to set norms
   # using the full matrix method for complete station records.
-  norms,norme,pars,X,Q = glosat_homogenization.solve_norms( dnorm, flags, cov, tor, nfourier )
+  norms,norme,pars,X,Q = glosat_homogenization.solve_norms( dnorm, flags, cov, tor, nfourier, method=solver )
   dfull = dnorm - norms
 
   # calculate local expectations
@@ -11,6 +11,13 @@ Arguments:
  -filter=<filter> : only use stations with given prefix
  -years=<year>,<year> : years for calculation (default 1780,2020)
  -bases=<year>,<year> : baseline years (default 1961,1990)
+ -distcache=<dir> : directory for cached distance matrices
+ -tol=<value> : stop norm iterations when the norms change by less than this
+ -accel=anderson : accelerate the norm iterations by Anderson mixing
+ -ensemble=<mode> : norm uncertainty ensemble, batched, serial or parallel (default batched)
+ -workers=<n> : number of processes for a parallel ensemble (default one per CPU)
+ -seed=<n> : random seed for a parallel ensemble
+ -members=<filename> : .npy file for the norms of each ensemble member
 
 If cycles is zero (the default), then calculate local expectation only.
 """
@@ -21,10 +28,17 @@ import sys, math, numpy, pandas, glosat_homogenization
 def main():
   # command line arguments
   year0,year1 = 1780,2020
+  distcache = None
   base0,base1 = 1961,1990
   stationfilter = None
   crossval = None
   tor = 0.1
+  tol = None
+  accel = None
+  ensemble = "batched"
+  workers = None
+  seed = None
+  members = None
   nfourier = 0
   ncycle   = 10
   rebaseline = True
@@ -36,6 +50,20 @@ def main():
       ifile = arg.split("=")[1]
     if arg.split("=")[0] == "-o":        # output file
       ofile = arg.split("=")[1]
+    if arg.split("=")[0] == "-distcache": # distance matrix cache
+      distcache = arg.split("=")[1]
+    if arg.split("=")[0] == "-tol":      # norm iteration tolerance
+      tol = float(arg.split("=")[1])
+    if arg.split("=")[0] == "-accel":    # norm iteration acceleration
+      accel = arg.split("=")[1]
+    if arg.split("=")[0] == "-ensemble": # uncertainty ensemble mode
+      ensemble = arg.split("=")[1]
+    if arg.split("=")[0] == "-workers":  # processes for parallel ensemble
+      workers = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-seed":     # seed for parallel ensemble
+      seed = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-members":  # ensemble member output file
+      members = arg.split("=")[1]
     if arg.split("=")[0] == "-years":    # year calc
       year0,year1 = [int(x) for x in arg.split("=")[1].split(",")]
     if arg.split("=")[0] == "-bases":    # year calc
@@ -91,7 +119,7 @@ def main():
   ctrys = dsub.loc[:,"stationcountry"].values
   lats  = dsub.loc[:,"stationlat"].values
   lons  = dsub.loc[:,"stationlon"].values
-  dists = glosat_homogenization.prepare_dists( lats, lons )
+  dists = glosat_homogenization.prepare_dists( lats, lons, cachedir=distcache )
 
   # and full data
   dcodes = dflt.loc[:,"stationcode"].values
@@ -132,6 +160,9 @@ def main():
   data[data>100.0] -= 200.0
   print("Data flag removal ",numpy.nanmin(data),numpy.nanmax(data))
 
+  # report the mask compression, i.e. how many months share each set of reporting stations
+  glosat_homogenization.mask_groups( ~numpy.isnan(data), report=True )
+
   # simple normalization for annual cycle
   # -------------------------------------
   # This step does a basic anomaly calculation to remove the bulk of the annual cycle
@@ -144,7 +175,9 @@ def main():
   # -------------------------------
   # We create an empyty array of station breakpoint flags in order to set norms
   # using the full matrix method for complete station records.
-  norms,norme = glosat_homogenization.solve_norms_iter_err( dnorm, flags, cov, tor, nfourier )
+  norms,norme = glosat_homogenization.solve_norms_iter_err( dnorm, flags, cov, tor, nfourier, tol=tol, accel=accel,
+                                                            ensemble=ensemble, workers=workers, seed=seed,
+                                                            store=members )
   dfull = dnorm - norms
 
   # calculate local expectations
@@ -10,29 +10,42 @@ Arguments:
  -filter=<filter> : only use stations with given prefix
  -years=<year>,<year> : years for calculation (default 1780,2020)
  -bases=<year>,<year> : baseline years (default 1961,1990)
+ -distcache=<dir> : directory for cached distance matrices
+ -solver=<method> : norm solver, dense, normal, sparse or lsqr (default dense)
+ -cpengine=<engine> : changepoint detection, native, coarse or ruptures (default native)
+ -penalty=<value> : changepoint penalty (default 10)
 
 If cycles is zero (the default), then calculate local expectation only.
 """
-import sys, math, numpy, pandas, ruptures, glosat_homogenization
+import sys, math, numpy, pandas, glosat_homogenization
 
 
 # Change point detection using Killick 2012, Truong 2020
 def changepoints( dorig, **opts ):
   """
-  Change point detection using PELT (Killick 2012),
-  implemented in the ruptures package (Truong 2020)
+  Change point detection using PELT (Killick 2012), for a change in mean,
+  by default with glosat_homogenization.pelt, or else implemented in the
+  ruptures package (Truong 2020)
   
   Parameters:
     dorig (vector of float): original data with no seasonal cycle, e.g.
       difference between obs and local expectation. No missing values.
     opts (dictionary): additional options, including:
       "nbuf": minimum number of months between changepoints
+      "engine": "native" (default), "coarse" to search annual means
+        first and refine to the month, see pelt_coarse, or "ruptures"
+      "pen": penalty per changepoint (default 10)
     
   Returns:
     (list of float): list of indices of changepoints
   """  
   min_size = opts["nbuf"]
-  penalty_value = 10
+  penalty_value = opts.get( "pen", 10 )
+  if opts.get( "engine", "native" ) == "native":
+    return glosat_homogenization.pelt( dorig, penalty_value, min_size )
+  if opts.get( "engine" ) == "coarse":
+    return glosat_homogenization.pelt_coarse( dorig, penalty_value, min_size )
+  import ruptures
   algo = ruptures.KernelCPD(kernel="linear",min_size=min_size).fit(dorig)
   #algo = ruptures.Pelt(model="l2", min_size=min_size).fit(dorig)
   result = algo.predict(pen=penalty_value)
@@ -69,9 +82,13 @@ def changemissing( dnorm, **opts ):
 def main():
   # command line arguments
   year0,year1 = 1780,2020
+  distcache = None
   base0,base1 = 1961,1990
   stationfilter = None
   tor = 0.1
+  solver = "dense"
+  cpengine = "native"
+  penalty = 10.0
   nfourier = 0
   ncycle   = 10
   rebaseline = True
@@ -83,6 +100,14 @@ def main():
       ifile = arg.split("=")[1]
     if arg.split("=")[0] == "-o":        # output file
       ofile = arg.split("=")[1]
+    if arg.split("=")[0] == "-distcache": # distance matrix cache
+      distcache = arg.split("=")[1]
+    if arg.split("=")[0] == "-solver":   # norm solver
+      solver = arg.split("=")[1]
+    if arg.split("=")[0] == "-cpengine": # changepoint detection engine
+      cpengine = arg.split("=")[1]
+    if arg.split("=")[0] == "-penalty":  # changepoint penalty
+      penalty = float(arg.split("=")[1])
     if arg.split("=")[0] == "-years":    # year calc
       year0,year1 = [int(x) for x in arg.split("=")[1].split(",")]
     if arg.split("=")[0] == "-bases":    # year calc
@@ -128,7 +153,7 @@ def main():
   ctrys = dsub.loc[:,"stationcountry"].values
   lats  = dsub.loc[:,"stationlat"].values
   lons  = dsub.loc[:,"stationlon"].values
-  dists = glosat_homogenization.prepare_dists( lats, lons )
+  dists = glosat_homogenization.prepare_dists( lats, lons, cachedir=distcache )
 
   # and full data
   dcodes = dflt.loc[:,"stationcode"].values
@@ -169,6 +194,9 @@ def main():
   data[data>100.0] -= 200.0
   print("Data flag removal ",numpy.nanmin(data),numpy.nanmax(data))
 
+  # report the mask compression, i.e. how many months share each set of reporting stations
+  glosat_homogenization.mask_groups( ~numpy.isnan(data), report=True )
+
   # simple normalization for annual cycle
   # -------------------------------------
   # This step does a basic anomaly calculation to remove the bulk of the annual cycle
@@ -199,8 +227,10 @@ def main():
   # its expectation, then updateing the norms and expectations.
   for cycle in range(ncycle):
     for s in range(nstn):
-      flags[:,s] = changemissing( dnorm[:,s] - dlexp[:,s], nbuf=12 )
-    norms,norme,pars,X,Q = glosat_homogenization.solve_norms( dnorm, flags, cov, tor, nfourier )
+      flags[:,s] = changemissing( dnorm[:,s] - dlexp[:,s], nbuf=12, engine=cpengine, pen=penalty )
+    # the parameter covariance is only dumped from the last cycle
+    norms,norme,pars,X,Q = glosat_homogenization.solve_norms( dnorm, flags, cov, tor, nfourier,
+                                                              diagnostics=( 2 if cycle == ncycle-1 else 1 ), method=solver )
     dfull = dnorm - norms
     dlexp,var = glosat_homogenization.local_expectation( dfull, cov, tor )
 
@@ -225,24 +255,25 @@ def main():
   # Output
   # ------
   # The rest of the calculation is just collecting data for output.
-  # covariance data
-  print(Q)
-  covx,covy,covz = [],[],[]
-  for i in range(len(pars)):
-    for j in range(len(pars)):
-      f1,s1 = pars[i]
-      f2,s2 = pars[j]
-      covx.append(dists[s1,s2])
-      covy.append(Q[i,j])
-      covz.append(numpy.count_nonzero(numpy.logical_and(flags[:,s1]==f1,flags[:,s2]==f2)))
-  cov = pandas.DataFrame({"dist":covx,"cov":covy,"overlap":covz})
-  print("Self:              ",numpy.mean(cov["cov"][cov["dist"]<0.5]))
-  print("Other:             ",numpy.mean(cov["cov"][cov["dist"]>0.5]))
-  print("Self,  overlap:    ",numpy.mean(cov["cov"][numpy.logical_and(cov["dist"]<0.5,cov["overlap"]>0.5)]))
-  print("Self,  no overlap: ",numpy.mean(cov["cov"][numpy.logical_and(cov["dist"]<0.5,cov["overlap"]<0.5)]))
-  print("Other, overlap:    ",numpy.mean(cov["cov"][numpy.logical_and(cov["dist"]>0.5,cov["overlap"]>0.5)]))
-  print("Other, no overlap: ",numpy.mean(cov["cov"][numpy.logical_and(cov["dist"]>0.5,cov["overlap"]<0.5)]))
-  cov.to_csv("cov.csv",sep=" ",index=False)
+  # covariance data (from the last cycle only)
+  if Q is not None:
+    print(Q)
+    covx,covy,covz = [],[],[]
+    for i in range(len(pars)):
+      for j in range(len(pars)):
+        f1,s1 = pars[i]
+        f2,s2 = pars[j]
+        covx.append(dists[s1,s2])
+        covy.append(Q[i,j])
+        covz.append(numpy.count_nonzero(numpy.logical_and(flags[:,s1]==f1,flags[:,s2]==f2)))
+    cov = pandas.DataFrame({"dist":covx,"cov":covy,"overlap":covz})
+    print("Self:              ",numpy.mean(cov["cov"][cov["dist"]<0.5]))
+    print("Other:             ",numpy.mean(cov["cov"][cov["dist"]>0.5]))
+    print("Self,  overlap:    ",numpy.mean(cov["cov"][numpy.logical_and(cov["dist"]<0.5,cov["overlap"]>0.5)]))
+    print("Self,  no overlap: ",numpy.mean(cov["cov"][numpy.logical_and(cov["dist"]<0.5,cov["overlap"]<0.5)]))
+    print("Other, overlap:    ",numpy.mean(cov["cov"][numpy.logical_and(cov["dist"]>0.5,cov["overlap"]>0.5)]))
+    print("Other, no overlap: ",numpy.mean(cov["cov"][numpy.logical_and(cov["dist"]>0.5,cov["overlap"]<0.5)]))
+    cov.to_csv("cov.csv",sep=" ",index=False)
 
   # update station baselines to match filled data
   diff = data - norms - dlexp
@@ -11,29 +11,70 @@ Arguments:
  -filter=<filter> : only use stations with given prefix
  -years=<year>,<year> : years for calculation (default 1780,2020)
  -bases=<year>,<year> : baseline years (default 1961,1990)
+ -cache=<MB> : memory budget for cached kriging factorisations (default 1024 if all the
+   distinct station masks fit, otherwise disabled; 0 to disable)
+ -krig=<method> : local expectation method, weights, dual or exact (default weights)
+ -taper=<km> : use a sparse covariance tapered to zero at the given radius
+ -nearest=<k> : krige each station from its k nearest reporting stations
+ -radius=<km> : with -nearest, only use reporting stations within this distance
+ -distcache=<dir> : directory for cached distance matrices
+ -incremental : update the kriging factorisation as stations join and leave,
+                rather than factorising each mask (dense covariance; most effective
+                with -krig=dual or exact)
+ -cg=<rtol> : solve the kriging systems by conjugate gradients to this relative
+              residual tolerance, starting from the previous mask (weights method).
+              The error in the expectations can be a few hundred times rtol,
+              so 1e-10 gives about 1e-7
+ -cgmaxiter=<n> : iterations before a conjugate gradient solve falls back to a direct
+                  solve (default twice the reporting stations, at least 200)
+ -cpworkers=<n> : number of processes for changepoint detection (default serial)
+ -cpchunk=<n> : number of stations per changepoint detection task (default 16)
+ -tol=<value> : stop norm iterations when the norms change by less than this
+ -accel=anderson : accelerate the norm iterations by Anderson mixing
+ -ensemble=<mode> : norm uncertainty ensemble, batched, serial or parallel (default batched)
+ -workers=<n> : number of processes for a parallel ensemble (default one per CPU)
+ -seed=<n> : random seed for a parallel ensemble
+ -members=<filename> : .npy file for the norms of each ensemble member
+ -cpengine=<engine> : changepoint detection, native, coarse or ruptures (default native)
+ -penalty=<value> : changepoint penalty (default 10)
+ -crops=<min>,<max>,<filename> : after the cycles, save the changepoints of each station
+                                 for every penalty in the range to a .npz file
+ -cptol=<value> : only redetect changepoints for stations whose residuals have changed
+                  by more than this since their last detection, and stop the cycles
+                  once no station's changepoints change
 
 If cycles is zero (the default), then calculate local expectation only.
 """
-import sys, math, numpy, pandas, ruptures, glosat_homogenization
+import sys, math, concurrent.futures, multiprocessing.shared_memory
+import numpy, pandas, glosat_homogenization
 
 
 # Change point detection using Killick 2012, Truong 2020
 def changepoints( dorig, **opts ):
   """
-  Change point detection using PELT (Killick 2012),
-  implemented in the ruptures package (Truong 2020)
+  Change point detection using PELT (Killick 2012), for a change in mean,
+  by default with glosat_homogenization.pelt, or else implemented in the
+  ruptures package (Truong 2020)
   
   Parameters:
     dorig (vector of float): original data with no seasonal cycle, e.g.
       difference between obs and local expectation. No missing values.
     opts (dictionary): additional options, including:
       "nbuf": minimum number of months between changepoints
+      "engine": "native" (default), "coarse" to search annual means
+        first and refine to the month, see pelt_coarse, or "ruptures"
+      "pen": penalty per changepoint (default 10)
     
   Returns:
     (list of float): list of indices of changepoints
   """  
   min_size = opts["nbuf"]
-  penalty_value = 10
+  penalty_value = opts.get( "pen", 10 )
+  if opts.get( "engine", "native" ) == "native":
+    return glosat_homogenization.pelt( dorig, penalty_value, min_size )
+  if opts.get( "engine" ) == "coarse":
+    return glosat_homogenization.pelt_coarse( dorig, penalty_value, min_size )
+  import ruptures
   algo = ruptures.KernelCPD(kernel="linear",min_size=min_size).fit(dorig)
   #algo = ruptures.Pelt(model="l2", min_size=min_size).fit(dorig)
   result = algo.predict(pen=penalty_value)
@@ -65,26 +106,142 @@ def changemissing( dnorm, **opts ):
   return flags
 
 
+# changepoints for a range of penalties on data with breaks
+def changepath( dnorm, pmin, pmax, **opts ):
+  """
+  Changepoints over a range of penalties, allowing missing data.
+  
+  Parameters:
+    dnorm (vector of float): data with no seasonal cycle, e.g. difference
+      between obs and local expectation, with missing values
+    pmin,pmax (float): range of penalties
+    opts (dictionary): options, including "nbuf", as for changepoints
+    
+  Returns:
+    (list of tuple): (lowest penalty, highest penalty, vector of months at
+      which new fragments begin) for each distinct set of changepoints
+  """
+  mask = ~numpy.isnan(dnorm)
+  diff = dnorm[mask]
+  index = numpy.arange( dnorm.shape[0] )[mask]
+  if diff.shape[0] <= 2*opts["nbuf"]: return [ ( pmin, pmax, numpy.zeros( [0], dtype=int ) ) ]
+  path = glosat_homogenization.crops( diff, pmin, pmax, opts["nbuf"] )
+  return [ ( lo, hi, index[numpy.array( b, dtype=int )] ) for lo, hi, b in path ]
+
+
+# residuals and options shared by the changepoint tasks within each process
+_changepoint_state = None
+
+# set up a changepoint worker process, attached to the shared residuals
+def _changepoint_init( name, shape, opts ):
+  global _changepoint_state
+  shm = multiprocessing.shared_memory.SharedMemory( name=name )
+  _changepoint_state = ( shm, numpy.ndarray( shape, dtype=numpy.float64, buffer=shm.buf ), opts )
+
+
+# flags for a chunk of stations
+def _changepoint_chunk( cols ):
+  shm, resid, opts = _changepoint_state
+  return numpy.stack( [ changemissing( resid[:,s], **opts ) for s in cols ], axis=1 )
+
+
+# changepoint detection for every station on a pool of processes
+class ChangepointPool:
+  """
+  Pool of processes detecting changepoints for chunks of stations. The
+  residuals are written to shared memory once per cycle, rather than sent
+  to the workers with each task, and the flags are the same as those from
+  calling changemissing for each station in turn.
+  
+  Parameters:
+    shape (tuple of int): [nmon,nstn] shape of the residuals
+    workers (int): number of processes, default one per CPU
+    chunk (int): number of stations per task
+    opts (dictionary): options for changemissing
+  """
+  def __init__( self, shape, workers=None, chunk=16, **opts ):
+    self.chunk = chunk
+    self.shm = multiprocessing.shared_memory.SharedMemory( create=True, size=max( 8*shape[0]*shape[1], 1 ) )
+    self.resid = numpy.ndarray( shape, dtype=numpy.float64, buffer=self.shm.buf )
+    self.pool = concurrent.futures.ProcessPoolExecutor( workers, initializer=_changepoint_init,
+                                                        initargs=( self.shm.name, shape, opts ) )
+
+  def flags( self, resid, stations=None ):
+    """
+    Return the [nmon,nsel] station fragment flags for the given residuals,
+    for the selected stations, or all stations if none are given.
+    """
+    self.resid[:] = resid
+    if stations is None: stations = numpy.arange( resid.shape[1] )
+    if len(stations) == 0: return numpy.zeros( [resid.shape[0],0], dtype=numpy.uint8 )
+    cols = [ stations[s:s+self.chunk] for s in range(0,len(stations),self.chunk) ]
+    return numpy.concatenate( list( self.pool.map( _changepoint_chunk, cols ) ), axis=1 )
+
+  def close( self ):
+    """
+    Stop the workers and release the shared memory.
+    """
+    self.pool.shutdown()
+    del self.resid
+    self.shm.close()
+    self.shm.unlink()
+
+
 
 # MAIN PROGRAM
 def main():
   # command line arguments
   year0,year1 = 1780,2020
+  distcache = None
   base0,base1 = 1961,1990
   stationfilter = None
   crossval = None
   tor = 0.1
+  tol = None
+  accel = None
+  ensemble = "batched"
+  workers = None
+  seed = None
+  members = None
   nfourier = 0
   ncycle   = 10
   rebaseline = True
   ifile = None
   ofile = None
+  cachemb = None
+  krig = "weights"
+  taper = None
+  nearest = None
+  radius = None
+  incremental = False
+  cgtol = None
+  cgmaxiter = None
+  cpworkers = None
+  cpchunk = 16
+  cpengine = "native"
+  penalty = 10.0
+  crops = None
+  cptol = None
 
   for arg in sys.argv[1:]:
     if arg.split("=")[0] == "-i":        # input file
       ifile = arg.split("=")[1]
     if arg.split("=")[0] == "-o":        # output file
       ofile = arg.split("=")[1]
+    if arg.split("=")[0] == "-distcache": # distance matrix cache
+      distcache = arg.split("=")[1]
+    if arg.split("=")[0] == "-tol":      # norm iteration tolerance
+      tol = float(arg.split("=")[1])
+    if arg.split("=")[0] == "-accel":    # norm iteration acceleration
+      accel = arg.split("=")[1]
+    if arg.split("=")[0] == "-ensemble": # uncertainty ensemble mode
+      ensemble = arg.split("=")[1]
+    if arg.split("=")[0] == "-workers":  # processes for parallel ensemble
+      workers = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-seed":     # seed for parallel ensemble
+      seed = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-members":  # ensemble member output file
+      members = arg.split("=")[1]
     if arg.split("=")[0] == "-years":    # year calc
       year0,year1 = [int(x) for x in arg.split("=")[1].split(",")]
     if arg.split("=")[0] == "-bases":    # year calc
@@ -99,6 +256,34 @@ def main():
       ncycle   = int(arg.split("=")[1])
     if arg.split("=")[0] == "-no-baseline": # disable fit baseline
       rebaseline = False
+    if arg.split("=")[0] == "-cache":    # kriging factor cache size in MB
+      cachemb = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-krig":     # local expectation method
+      krig = arg.split("=")[1]
+    if arg.split("=")[0] == "-taper":    # covariance taper radius in km
+      taper = float(arg.split("=")[1])
+    if arg.split("=")[0] == "-nearest":  # number of neighbours for local kriging
+      nearest = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-radius":   # neighbour radius for local kriging in km
+      radius = float(arg.split("=")[1])
+    if arg.split("=")[0] == "-incremental": # incremental kriging factorisation
+      incremental = True
+    if arg.split("=")[0] == "-cg":       # conjugate gradient kriging tolerance
+      cgtol = float(arg.split("=")[1])
+    if arg.split("=")[0] == "-cgmaxiter": # conjugate gradient iteration limit
+      cgmaxiter = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-cpworkers": # processes for changepoint detection
+      cpworkers = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-cpchunk":  # stations per changepoint task
+      cpchunk = int(arg.split("=")[1])
+    if arg.split("=")[0] == "-cpengine": # changepoint detection engine
+      cpengine = arg.split("=")[1]
+    if arg.split("=")[0] == "-penalty":  # changepoint penalty
+      penalty = float(arg.split("=")[1])
+    if arg.split("=")[0] == "-crops":    # changepoint penalty path
+      crops = arg.split("=")[1].split(",")
+    if arg.split("=")[0] == "-cptol":    # residual change to redetect changepoints
+      cptol = float(arg.split("=")[1])
 
   # other defaults
   if ifile == None: ifile = "../DATA/df_temp.pkl"
@@ -140,7 +325,7 @@ def main():
   ctrys = dsub.loc[:,"stationcountry"].values
   lats  = dsub.loc[:,"stationlat"].values
   lons  = dsub.loc[:,"stationlon"].values
-  dists = glosat_homogenization.prepare_dists( lats, lons )
+  if taper is None and nearest is None: dists = glosat_homogenization.prepare_dists( lats, lons, cachedir=distcache )
 
   # and full data
   dcodes = dflt.loc[:,"stationcode"].values
@@ -170,7 +355,24 @@ def main():
         data[i+m,j] = dtemps[r,m]
 
   # set up covariance data
-  cov = numpy.exp( -dists/900.0 )
+  if nearest is not None:
+    cov = glosat_homogenization.StationIndex( lats, lons, 900.0, nearest, radius )
+  elif taper is not None:
+    cov = glosat_homogenization.prepare_taper_cov( lats, lons, 900.0, taper )
+  else:
+    cov = numpy.exp( -dists/900.0 )
+
+  # successive masks differ by a few stations, so the factorisation of the
+  # kriging system can be updated rather than recomputed
+  solver = None
+  if incremental and taper is None and nearest is None:
+    solver = glosat_homogenization.IncrementalKriging( cov, tor )
+  if cgtol is not None and nearest is None:
+    solver = glosat_homogenization.IterativeKriging( cov, tor, rtol=cgtol, maxiter=cgmaxiter )
+  if incremental and solver is None:
+    print( "WARNING: -incremental needs a dense covariance, and is ignored with -taper or -nearest" )
+  if cgtol is not None and ( solver is None or krig != "weights" ):
+    print( "WARNING: -cg only applies to -krig=weights without -nearest, and is ignored" )
 
   # set breakpoint flags - normally all empty, but we can use extreme values to mark known breaks
   # FIXME - update this once the input data contain breakpoint flags
@@ -181,6 +383,20 @@ def main():
   data[data>100.0] -= 200.0
   print("Data flag removal ",numpy.nanmin(data),numpy.nanmax(data))
 
+  # report the mask compression, and keep the masks to size the kriging cache
+  groups = glosat_homogenization.mask_groups( ~numpy.isnan(data), report=True )
+
+  # kriging factorisations depend only on the stations reporting in a month,
+  # and the same masks recur in every cycle and ensemble member, so cache
+  # them. The masks are visited in time order, so unless they all fit the
+  # least recently used entries are evicted before they are reused.
+  if cachemb is None:
+    cachest = sum( 8*numpy.count_nonzero(flag)**2 + 24*nstn for flag,js in groups )/2**20
+    cachemb = 1024 if cachest <= 1024 else 0
+    if cachemb == 0: print( "Kriging cache disabled, {:.0f} MB needed, use -cache to override".format( cachest ) )
+  cache = None
+  if cachemb > 0: cache = glosat_homogenization.KrigingCache( cachemb*2**20 )
+
   # simple normalization for annual cycle
   # -------------------------------------
   # This step does a basic anomaly calculation to remove the bulk of the annual cycle
@@ -202,27 +418,84 @@ def main():
   # ----------------------------
   # Now we calculate a local expectation at the location of each station using the
   # anomalies.
-  dlexp,var = glosat_homogenization.local_expectation( dfull, cov, tor )
+  dlexp,var = glosat_homogenization.local_expectation( dfull, cov, tor, cache=cache, method=krig, solver=solver )
   print( "INIT ", numpy.nanstd(dnorm), numpy.nanstd(dfull), numpy.nanstd(dlexp) )
 
   # Iteratively find breakpoints
   # ----------------------------
   # We loop over n cycles, finding breakpoints from the difference between a station and
   # its expectation, then updateing the norms and expectations.
+  # With acceleration, the norms are mixed with those of previous cycles
+  # for as long as the breakpoints stay the same.
+  # Stations are independent given the expectations, so can be spread over processes.
+  mixer = glosat_homogenization.AndersonMixer() if accel == "anderson" else None
+  cpool = None
+  if cpworkers is not None and ncycle > 0:
+    cpool = ChangepointPool( data.shape, cpworkers, cpchunk, nbuf=12, engine=cpengine, pen=penalty )
+  # With a tolerance, stations are only redetected once their residuals
+  # have moved since their last detection, and the cycles end once the
+  # flags and norms settle.
+  rlast = None
   for cycle in range(ncycle):
-    for s in range(nstn):
-      flags[:,s] = changemissing( dnorm[:,s] - dlexp[:,s], nbuf=12 )
-    norms = glosat_homogenization.fit_norms( dnorm - dlexp, flags, nfourier=nfourier )
+    flagp = flags.copy()
+    resid = dnorm - dlexp
+    dirty = numpy.arange( nstn )
+    if cptol is not None and rlast is not None:
+      rchange = numpy.abs( resid - rlast )
+      rchange[numpy.isnan(rchange)] = 0.0
+      dirty = numpy.nonzero( numpy.max( rchange, axis=0 ) > cptol )[0]
+    if cpool is None:
+      for s in dirty:
+        flags[:,s] = changemissing( resid[:,s], nbuf=12, engine=cpengine, pen=penalty )
+    else:
+      flags[:,dirty] = cpool.flags( resid, dirty )
+    if cptol is not None:
+      if rlast is None: rlast = resid.copy()
+      rlast[:,dirty] = resid[:,dirty]
+      nchange = numpy.count_nonzero( numpy.any( flags != flagp, axis=0 ) )
+      print( "CYCLE ", cycle, "redetected", dirty.size, "skipped", nstn-dirty.size, "changed", nchange )
+    normp = norms
+    norms = glosat_homogenization.fit_norms( resid, flags, nfourier=nfourier )
+    if mixer is not None:
+      if not numpy.array_equal( flags, flagp ): mixer.reset()
+      norms = mixer.update( normp, normp + glosat_homogenization.remove_common_shift( norms - normp ) )
     dfull = dnorm - norms
-    dlexp,var = glosat_homogenization.local_expectation( dfull, cov, tor )
+    dlexp,var = glosat_homogenization.local_expectation( dfull, cov, tor, cache=cache, method=krig, solver=solver )
+    # stop once the norms, refitted with the flags the previous fit also used,
+    # have settled as well
+    if cptol is not None and cycle > 0 and nchange == 0:
+      if numpy.max( numpy.abs( glosat_homogenization.remove_common_shift( norms - normp ) ) ) < cptol: break
+  if cpool is not None: cpool.close()
 
   print( "NORMS ", numpy.std(norms), numpy.sum(flags) )
 
+  # changepoint penalty path
+  # ------------------------
+  # The changepoints of each station for every penalty in a range, so that a
+  # penalty can be chosen without repeating the homogenization. Segmentation
+  # i of station[i] is optimal for penalties pmin[i] to pmax[i], and its
+  # fragments begin at months breaks[start[i]:start[i]+nbreak[i]].
+  if crops is not None:
+    path = [ ( s, )+p for s in range(nstn) for p in changepath( dnorm[:,s] - dlexp[:,s], float(crops[0]), float(crops[1]), nbuf=12 ) ]
+    nbreak = numpy.array( [ p[3].size for p in path ], dtype=int )
+    assert all( p[1] <= p[2] for p in path ), "CROPS penalty interval out of order"
+    numpy.savez( crops[2], codes=codes.astype(str), dates=dates,
+                 station=numpy.array( [ p[0] for p in path ], dtype=int ),
+                 pmin=numpy.array( [ p[1] for p in path ] ), pmax=numpy.array( [ p[2] for p in path ] ),
+                 nbreak=nbreak, start=numpy.cumsum( nbreak ) - nbreak,
+                 breaks=numpy.concatenate( [ p[3] for p in path ] + [ numpy.zeros( [0], dtype=int ) ] ) )
+    print( "CROPS ", len(path), "segmentations for", nstn, "stations" )
+
   # calculate norm uncertainties
   # ----------------------------
-  norms,norme = glosat_homogenization.solve_norms_iter_err( dnorm - dlexp, flags, cov, tor, nfourier=nfourier )
+  norms,norme = glosat_homogenization.solve_norms_iter_err( dnorm - dlexp, flags, cov, tor, nfourier=nfourier, cache=cache, krig=krig,
+                                                              tol=tol, init=( norms if tol is not None else None ),
+                                                              accel=accel, ensemble=ensemble, workers=workers, seed=seed,
+                                                              store=members, solver=solver )
   dfull = dnorm - norms
-  dlexp,var = glosat_homogenization.local_expectation( dfull, cov, tor )
+  dlexp,var = glosat_homogenization.local_expectation( dfull, cov, tor, cache=cache, method=krig, solver=solver )
+  if cache is not None: print( cache.summary() )
+  if solver is not None: print( solver.summary() )
 
   # calculate uncertainties
   # -----------------------
@@ -4,6 +4,7 @@ optionally homogenization using full matrix solution for the norms.
 
 Arguments:
  -i=<filename> : specific input pkl file (default ../DATA/df_temp.pkl)
+ -distcache=<dir> : directory for cached distance matrices
 
 If cycles is zero (the default), then calculate local expectation only.
 """
@@ -14,11 +15,14 @@ import sys, math, numpy, pandas, glosat_homogenization
 def main():
   # command line arguments
   year0,year1 = 1780,2020
+  distcache = None
   ifile = []
   apply_norms = True
   tor = 0.1
 
   for arg in sys.argv[1:]:
+    if arg.split("=")[0] == "-distcache": # distance matrix cache
+      distcache = arg.split("=")[1]
     if arg.split("=")[0] == "-years":    # year calc
       year0,year1 = [int(x) for x in arg.split("=")[1].split(",")]
     if arg.split("=")[0] == "-i":        # input file
@@ -53,7 +57,7 @@ def main():
   flags = dsub.loc[:,"xflag"].values
   lats  = dsub.loc[:,"stationlat"].values
   lons  = dsub.loc[:,"stationlon"].values
-  dists = glosat_homogenization.prepare_dists( lats, lons )
+  dists = glosat_homogenization.prepare_dists( lats, lons, cachedir=distcache )
 
   # and full data
   dcodes = dflt.loc[:,"stationcode"].values
@@ -94,11 +98,13 @@ def main():
   fill1 = data1.copy()
   fill0[numpy.isnan(fill0)] = 0.0
   fill1[numpy.isnan(fill1)] = 0.0
-  for j in range(data.shape[0]):
-    twgt = glosat_homogenization.interpolatew( data0[j,:], cov, tor )
-    fill0[j,:] = numpy.dot( fill0[j,:], twgt )
-    twgt = glosat_homogenization.interpolatew( data1[j,:], cov, tor )
-    fill1[j,:] = numpy.dot( fill1[j,:], twgt )
+  # one kriging solve for all the months with the same reporting stations
+  for flag, js in glosat_homogenization.mask_groups( ~numpy.isnan(data0), report=True ):
+    twgt = glosat_homogenization.interpolatew( data0[js[0],:], cov, tor )
+    fill0[js,:] = numpy.dot( fill0[js,:], twgt )
+  for flag, js in glosat_homogenization.mask_groups( ~numpy.isnan(data1), report=True ):
+    twgt = glosat_homogenization.interpolatew( data1[js[0],:], cov, tor )
+    fill1[js,:] = numpy.dot( fill1[js,:], twgt )
 
   # test
   for s in range(data.shape[1]):